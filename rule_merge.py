@@ -1,54 +1,150 @@
 import requests
-import yaml
+from requests.adapters import HTTPAdapter
 import os
 import sys
-from collections import OrderedDict
 from urllib.parse import urlparse
 import concurrent.futures
+import hashlib
+import json
 
-def get_script_dir():
-    return os.path.dirname(os.path.realpath(__file__))
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+CACHE_DIR = os.path.join(SCRIPT_DIR, '.rule_cache')
+CACHE_INDEX_FILE = os.path.join(CACHE_DIR, 'index.json')
 
-def download_rules(url):
+# Download threads and pooled connections per host; kept equal so no connection is discarded
+MAX_DOWNLOAD_WORKERS = 16
+
+DOMAIN_RULE_PREFIXES = ('DOMAIN,', 'DOMAIN-SUFFIX,', 'DOMAIN-KEYWORD,')
+
+# Shared so downloads from the same host reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': 'rule-merge'})
+SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_DOWNLOAD_WORKERS))
+
+def load_cache_index():
+    try:
+        with open(CACHE_INDEX_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_cache_index(cache_index):
+    try:
+        with open(CACHE_INDEX_FILE, 'w', encoding='utf-8') as f:
+            json.dump(cache_index, f, indent=2, sort_keys=True)
+    except IOError as e:
+        print(f"Error writing to {CACHE_INDEX_FILE}: {e}", file=sys.stderr)
+
+def read_cached_rules(entry):
     try:
-        response = requests.get(url, timeout=30)
+        with open(os.path.join(CACHE_DIR, entry['file']), 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+    except (IOError, KeyError):
+        return None
+
+def write_cached_rules(url, response, cache_index):
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        # Nothing to revalidate with, so an older entry would go stale
+        cache_index.pop(url, None)
+        return
+    file_name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(os.path.join(CACHE_DIR, file_name), 'w', encoding='utf-8', newline='') as f:
+            f.write(response.text)
+        cache_index[url] = {'etag': etag, 'last_modified': last_modified, 'file': file_name}
+    except IOError as e:
+        # The body file may be truncated; never revalidate against it
+        cache_index.pop(url, None)
+        print(f"Error caching rules from {url}: {e}", file=sys.stderr)
+
+def download_rules(url, cache_index):
+    # Revalidate the cached copy with a conditional GET; only use it on 304
+    entry = cache_index.get(url)
+    cached_content = read_cached_rules(entry) if entry else None
+    headers = {}
+    if cached_content is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        response = SESSION.get(url, headers=headers, timeout=30)
+        if response.status_code == 304 and cached_content is not None:
+            print(f"Rules from {url} not modified, using cached copy")
+            return cached_content
         response.raise_for_status()
+        # Rule lists are UTF-8; don't let requests guess from the body
+        response.encoding = 'utf-8'
         content = response.text
+        write_cached_rules(url, response, cache_index)
         print(f"Successfully downloaded rules from {url}")
         return content
     except requests.RequestException as e:
         print(f"Error downloading {url}: {e}", file=sys.stderr)
         return None
 
+def to_raw_url(url):
+    # github.com/<owner>/<repo>/blob/<ref>/<path> serves an HTML page, not the file
+    parsed = urlparse(url)
+    parts = parsed.path.split('/')
+    if parsed.netloc == 'github.com' and len(parts) > 5 and parts[3] == 'blob':
+        raw_url = f"https://raw.githubusercontent.com/{parts[1]}/{parts[2]}/{'/'.join(parts[4:])}"
+        print(f"Using {raw_url} instead of GitHub page {url}")
+        return raw_url
+    return url
+
 def download_all_rules(rule_sets_config):
     all_rules = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_url = {executor.submit(download_rules, url): (output_name, url, comment) 
-                         for output_name, urls in rule_sets_config.items() 
-                         for url, comment in urls}
+    cache_index = load_cache_index()
+    # A URL listed under several categories is only fetched once
+    url_to_sources = {}
+    for output_name, urls in rule_sets_config.items():
+        for url, comment in urls:
+            url_to_sources.setdefault(to_raw_url(url), []).append((output_name, comment))
+    # Resolve formats from the static config so unsupported URLs are never fetched
+    url_formats = {}
+    for url in url_to_sources:
+        try:
+            url_formats[url] = get_file_format(url)
+        except ValueError as e:
+            print(f"Skipping {url}: {e}", file=sys.stderr)
+    # One worker per URL, up to the session's pool size, so downloads run in parallel
+    max_workers = max(min(len(url_formats), MAX_DOWNLOAD_WORKERS), 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_url = {executor.submit(download_rules, url, cache_index): url for url in url_formats}
         for future in concurrent.futures.as_completed(future_to_url):
-            output_name, url, comment = future_to_url[future]
+            url = future_to_url[future]
+            comment = ', '.join(comment for _, comment in url_to_sources[url])
             try:
                 content = future.result()
                 if content:
-                    file_format = get_file_format(url)
-                    all_rules.setdefault(output_name, []).append((content, file_format, comment, url))
+                    file_format = url_formats[url]
+                    # Parse now so it overlaps with the downloads still in flight
+                    rules = parse_rules(content, file_format)
+                    for output_name, source_comment in url_to_sources[url]:
+                        all_rules.setdefault(output_name, []).append((rules, file_format, source_comment, url))
                     print(f"Successfully downloaded and processed rules from {comment} ({url})")
                 else:
                     print(f"Failed to download rules from {comment} ({url})")
             except Exception as exc:
                 print(f"{comment} ({url}) generated an exception: {exc}", file=sys.stderr)
+    # Also rewrite an existing index that lost its last entry
+    if cache_index or os.path.exists(CACHE_INDEX_FILE):
+        save_cache_index(cache_index)
     return all_rules
 
 def parse_rules(content, file_format):
     if content is None:
         return []
     try:
+        lines = map(str.strip, content.splitlines())
         if file_format == 'txt':
-            lines = content.splitlines()
-            return [line.strip() for line in lines if line.strip() and not line.strip().lower() == 'payload:']
+            return [line for line in lines if line and line.lower() != 'payload:']
         elif file_format in ['list']:
-            return [line.strip() for line in content.splitlines() if line.strip() and not line.startswith('#')]
+            return [line for line in lines if line and not line.startswith('#')]
         else:
             raise ValueError(f"Unsupported file format: {file_format}")
     except Exception as e:
@@ -56,10 +152,13 @@ def parse_rules(content, file_format):
         return []
 
 def convert_list_to_txt(rule):
-    if rule.startswith('DOMAIN,'):
-        return f"- '{rule.split(',')[1]}'"
-    elif rule.startswith('DOMAIN-SUFFIX,'):
-        return f"- '+.{rule.split(',')[1]}'"
+    rule_type, sep, rest = rule.partition(',')
+    if not sep:
+        return None
+    elif rule_type == 'DOMAIN':
+        return f"- '{rest.partition(',')[0]}'"
+    elif rule_type == 'DOMAIN-SUFFIX':
+        return f"- '+.{rest.partition(',')[0]}'"
     return None
 
 def convert_txt_to_conf(rule):
@@ -69,7 +168,7 @@ def convert_txt_to_conf(rule):
     elif rule.startswith("- '"):
         domain = rule[3:-1] if rule.endswith("'") else rule[3:]
         return f"DOMAIN,{domain},PROXY"
-    elif rule.startswith("DOMAIN-SUFFIX,") or rule.startswith("DOMAIN,") or rule.startswith("DOMAIN-KEYWORD,"):
+    elif rule.startswith(DOMAIN_RULE_PREFIXES):
         parts = rule.split(',')
         if len(parts) == 2:
             return f"{rule},PROXY"
@@ -86,7 +185,7 @@ def get_file_format(url):
         raise ValueError(f"Unsupported file format: {extension}")
 
 def read_custom_rules(file_name):
-    file_path = os.path.join(get_script_dir(), file_name)
+    file_path = os.path.join(SCRIPT_DIR, file_name)
     if not os.path.exists(file_path):
         print(f"Custom rule file {file_path} not found.")
         return {'direct': [], 'proxy': [], 'ai': []}
@@ -95,65 +194,76 @@ def read_custom_rules(file_name):
     current_category = None
     
     with open(file_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('#'):
-                if 'direct' in line.lower():
-                    current_category = 'direct'
-                elif 'proxy' in line.lower():
-                    current_category = 'proxy'
-                elif 'ai' in line.lower():
-                    current_category = 'ai'
-            elif line and current_category:
-                custom_rules[current_category].append(line)
+        text = f.read()
+
+    for line in map(str.strip, text.splitlines()):
+        if line.startswith('#'):
+            header = line.lower()
+            if 'direct' in header:
+                current_category = 'direct'
+            elif 'proxy' in header:
+                current_category = 'proxy'
+            elif 'ai' in header:
+                current_category = 'ai'
+        elif line and current_category:
+            custom_rules[current_category].append(line)
     
     return custom_rules
 
+def write_if_changed(file_path, text):
+    # Skip the write when the file already holds exactly this text
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            if f.read() == text:
+                return False
+    except (IOError, ValueError):
+        pass
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return True
+
 def save_rules_txt(rules, output_file):
-    file_path = os.path.join(get_script_dir(), output_file)
+    file_path = os.path.join(SCRIPT_DIR, output_file)
+    text = "payload:\n" + "".join([f"  {rule}\n" for rule in rules])
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write("payload:\n")
-            for rule in rules:
-                f.write(f"  {rule}\n")
-        print(f"Generated {file_path} with {len(rules)} rules")
+        if write_if_changed(file_path, text):
+            print(f"Generated {file_path} with {len(rules)} rules")
+        else:
+            print(f"{file_path} is unchanged with {len(rules)} rules, skipped writing")
     except IOError as e:
         print(f"Error writing to {file_path}: {e}", file=sys.stderr)
 
 def process_rules(rule_sets, custom_rules):
-    all_processed_rules = custom_rules.copy()
-    for content, file_format, comment, url in rule_sets:
-        rules = parse_rules(content, file_format)
+    all_processed_rules = set(custom_rules)
+    for rules, file_format, comment, url in rule_sets:
         original_count = len(rules)
         if file_format == 'list':
-            processed_rules = [convert_list_to_txt(rule) for rule in rules if convert_list_to_txt(rule)]
+            processed_rules = [converted for rule in rules if (converted := convert_list_to_txt(rule))]
         else:
             processed_rules = rules
-        all_processed_rules.extend(processed_rules)
+        all_processed_rules.update(processed_rules)
         print(f"Added {len(processed_rules)} rules from {comment} (Original: {original_count})")
 
-    all_processed_rules = sorted(set(all_processed_rules))
-    return all_processed_rules
+    return remove_covered_rules(sorted(all_processed_rules), split_txt_rule)
 
 def process_rules_for_conf(rule_sets, custom_rules):
-    all_processed_rules = []
-    for content, file_format, comment, url in rule_sets:
-        rules = parse_rules(content, file_format)
+    all_processed_rules = set()
+    for rules, file_format, comment, url in rule_sets:
         original_count = len(rules)
         if file_format == 'list':
-            processed_rules = [rule for rule in rules if rule.startswith(('DOMAIN,', 'DOMAIN-SUFFIX,', 'DOMAIN-KEYWORD,'))]
+            processed_rules = [format_rule(rule) for rule in rules if rule.startswith(DOMAIN_RULE_PREFIXES)]
         else:  # 'txt' format
-            processed_rules = [convert_txt_to_conf(rule) for rule in rules]
-        all_processed_rules.extend(processed_rules)
+            processed_rules = [format_rule(rule) for rule in rules]
+        all_processed_rules.update(processed_rules)
         print(f"Added {len(processed_rules)} rules from {comment} (Original: {original_count})")
     
-    all_processed_rules.extend(custom_rules)
-    return sorted(set(all_processed_rules))
+    all_processed_rules.update(format_rule(rule) for rule in custom_rules)
+    return sorted(all_processed_rules)
 
 def format_rule(rule):
-    if rule.startswith("- '+.") or rule.startswith("- '"):
+    if rule.startswith("- '"):
         return convert_txt_to_conf(rule)
-    elif not (rule.startswith("DOMAIN-SUFFIX,") or rule.startswith("DOMAIN,") or rule.startswith("DOMAIN-KEYWORD,")):
+    elif not rule.startswith(DOMAIN_RULE_PREFIXES):
         return f"DOMAIN-SUFFIX,{rule},PROXY"
     else:
         parts = rule.split(',')
@@ -163,19 +273,56 @@ def format_rule(rule):
             return f"{parts[0]},{parts[1]},PROXY"
     return rule
 
+def split_txt_rule(rule):
+    if rule.startswith("- '+."):
+        return True, rule[5:-1] if rule.endswith("'") else rule[5:]
+    elif rule.startswith("- '"):
+        return False, rule[3:-1] if rule.endswith("'") else rule[3:]
+    return None
+
+def split_conf_rule(rule):
+    rule_type, _, rest = rule.partition(',')
+    if rule_type == 'DOMAIN-SUFFIX':
+        return True, rest.partition(',')[0]
+    elif rule_type == 'DOMAIN':
+        return False, rest.partition(',')[0]
+    return None
+
+def remove_covered_rules(rules, split_rule):
+    # A suffix rule matches the domain itself and every subdomain, so any
+    # rule for that domain or below it is redundant. Keyword/IP rules are kept.
+    split_rules = [(rule, split_rule(rule)) for rule in rules]
+    suffixes = {split[1] for _, split in split_rules if split and split[0]}
+    kept = []
+    for rule, split in split_rules:
+        if split:
+            is_suffix, domain = split
+            covered = not is_suffix and domain in suffixes
+            dot = domain.find('.')
+            while not covered and dot != -1:
+                covered = domain[dot + 1:] in suffixes
+                dot = domain.find('.', dot + 1)
+            if covered:
+                continue
+        kept.append(rule)
+    if len(kept) != len(rules):
+        print(f"Removed {len(rules) - len(kept)} rules already covered by a suffix rule")
+    return kept
+
 def generate_merged_rules_conf(all_downloaded_rules, custom_rules):
-    proxy_rules = process_rules_for_conf(all_downloaded_rules.get("Proxy", []), custom_rules.get('proxy', []))
-    ai_rules = process_rules_for_conf(all_downloaded_rules.get("Ai", []), custom_rules.get('ai', []))
-    
-    merged_conf_rules = sorted(set(proxy_rules + ai_rules))
+    # Proxy and Ai share one conf, so merge them in a single dedupe + sort
+    merged_conf_rules = process_rules_for_conf(
+        all_downloaded_rules.get("Proxy", []) + all_downloaded_rules.get("Ai", []),
+        custom_rules.get('proxy', []) + custom_rules.get('ai', []))
+    merged_conf_rules = remove_covered_rules(merged_conf_rules, split_conf_rule)
     
-    merged_conf_file = os.path.join(get_script_dir(), "merged_rules.conf")
+    merged_conf_file = os.path.join(SCRIPT_DIR, "merged_rules.conf")
+    text = "".join([f"{rule}\n" for rule in merged_conf_rules])
     try:
-        with open(merged_conf_file, 'w', encoding='utf-8') as f:
-            for rule in merged_conf_rules:
-                formatted_rule = format_rule(rule)
-                f.write(f"{formatted_rule}\n")
-        print(f"Generated {merged_conf_file} with {len(merged_conf_rules)} unique rules")
+        if write_if_changed(merged_conf_file, text):
+            print(f"Generated {merged_conf_file} with {len(merged_conf_rules)} unique rules")
+        else:
+            print(f"{merged_conf_file} is unchanged with {len(merged_conf_rules)} unique rules, skipped writing")
     except IOError as e:
         print(f"Error writing to {merged_conf_file}: {e}", file=sys.stderr)
 